@@ -47,6 +47,8 @@ class Config(object):
     ode_solver (str): The ODE solver methods used for numerical simulation,
                       supported input: ["euler", "midpoint", "heun"(default), "rk4"]
     ode_last_steps (int): The number of last iterations used to determine oscillation, default: 2.
+    ode_precision (str): The precision of the weighted sum W*x in dx/dt, supported: ["float32" (default), "bfloat16"].
+                         With "bfloat16" the matmul runs in bfloat16 while the ODE states are kept in float32.
 
     ### Traning procedure
     seed (int): The random seed used for numpy (e.g. data partition) and tensorflow (model training),
@@ -97,6 +99,9 @@ class Config(object):
         self.ode_degree = config_dict["ode_degree"] if "ode_degree" in config_dict else 1
         assert self.ode_degree in [1, 2], NotImplementedError
         self.ode_last_steps = config_dict["ode_last_steps"] if "ode_last_steps" in config_dict else 2
+        assert self.ode_last_steps >= 1, "ode_last_steps needs to summarize at least the last step"
+        self.ode_precision = config_dict["ode_precision"] if "ode_precision" in config_dict else "float32"
+        assert self.ode_precision in ["float32", "bfloat16"], NotImplementedError
 
         self.n_iter_buffer = config_dict["n_iter_buffer"] if "n_iter_buffer" in config_dict else 5
         self.n_iter_patience = config_dict["n_iter_patience"] if "n_iter_patience" in config_dict else 100
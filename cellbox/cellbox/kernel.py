@@ -31,27 +31,41 @@ def get_envelope(args):
     return args.envelope_fn
 
 
-def dxdt(args, params):
-    """calculate the derivatives dx/dt in the ODEs"""
+def get_dxdt(args, params):
+    """calculate the derivatives dx/dt in the ODEs, with states and perturbations of shape [batch_size, n_x]"""
+    if args.ode_precision == 'bfloat16':
+        # only the matmul runs in bfloat16, the states are still accumulated in float32
+        W_bf16 = tf.cast(params['W'], tf.bfloat16)
+
+        def matmul(x):
+            return tf.cast(tf.matmul(tf.cast(x, tf.bfloat16), W_bf16, transpose_b=True), tf.float32)
+    elif args.ode_precision == 'float32':
+        def matmul(x):
+            return tf.matmul(x, params['W'], transpose_b=True)
+    else:
+        raise Exception("Illegal ODE precision. Choose from [float32, bfloat16].")
+
     if args.ode_degree == 1:
         def weighted_sum(x):
-            return tf.matmul(params['W'], x)
+            return matmul(x)
     elif args.ode_degree == 2:
         def weighted_sum(x):
-            return tf.matmul(params['W'], x) + tf.reshape(tf.reduce_sum(params['W'], axis=1), [args.n_x, 1]) * x
+            return matmul(x) + tf.reduce_sum(params['W'], axis=1) * x
     else:
         raise Exception("Illegal ODE degree. Choose from [1,2].")
 
+    # [n_x, 1] parameters as [1, n_x] rows that broadcast over the batch
+    eps, alpha = tf.reshape(params['eps'], [1, -1]), tf.reshape(params['alpha'], [1, -1])
     if args.envelope == 0:
         # epsilon*phi(Sigma+u)-alpha*x
-        return lambda x, t_mu: params['eps'] * args.envelope_fn(weighted_sum(x) + t_mu) - params['alpha'] * x
+        return lambda x, mu: eps * args.envelope_fn(weighted_sum(x) + mu) - alpha * x
     if args.envelope == 1:
         # epsilon*[phi(Sigma)+u]-alpha*x
-        return lambda x, t_mu: params['eps'] * (args.envelope_fn(weighted_sum(x)) + t_mu) - params['alpha'] * x
+        return lambda x, mu: eps * (args.envelope_fn(weighted_sum(x)) + mu) - alpha * x
     if args.envelope == 2:
         # epsilon*phi(Sigma)+psi*u-alpha*x
-        return lambda x, t_mu: params['eps'] * args.envelope_fn(weighted_sum(x)) + params['psi'] * t_mu - \
-                               params['alpha'] * x
+        psi = tf.reshape(params['psi'], [1, -1])
+        return lambda x, mu: eps * args.envelope_fn(weighted_sum(x)) + psi * mu - alpha * x
     raise Exception("Illegal envelope type. Choose from [0,1,2].")
 
 
@@ -68,62 +82,73 @@ def get_ode_solver(args):
     raise Exception("Illegal ODE solver. Use [heun, euler, rk4, midpoint]")
 
 
-def heun_solver(x, t_mu, dT, n_T, _dXdt, n_activity_nodes=None):
-    """Heun's ODE solver"""
-    xs = []
-    n_x = t_mu.shape[0]
+def _integrate(x, mu, n_T, step, n_activity_nodes=None, n_last_steps=None):
+    """
+    Advance the ODEs n_T times with a given update step
+
+    Returns:
+        mean, var (tf.Tensor): moments of the states over the last n_last_steps steps, shape: [batch_size, n_x]
+        x (tf.Tensor): the state after the last step, shape: [batch_size, n_x]
+    """
+    n_x = mu.shape[1]
     n_activity_nodes = n_x if n_activity_nodes is None else n_activity_nodes
-    dxdt_mask = tf.pad(tf.ones((n_activity_nodes, 1)), [[0, n_x - n_activity_nodes], [0, 0]])
-    for _ in range(n_T):
-        dxdt_current = _dXdt(x, t_mu)
-        dxdt_next = _dXdt(x + dT * dxdt_current, t_mu)
-        x = x + dT * 0.5 * (dxdt_current + dxdt_next) * dxdt_mask
-        xs.append(x)
-    xs = tf.stack(xs, axis=0)
-    return xs
+    n_last_steps = n_T if n_last_steps is None else min(n_last_steps, n_T)
+    dxdt_mask = tf.pad(tf.ones((1, n_activity_nodes)), [[0, 0], [0, n_x - n_activity_nodes]])
+    # fix the state shape to [batch_size, n_x] so that it is a loop invariant
+    x = tf.broadcast_to(x, tf.shape(mu))
+
+    def advance(i, x):
+        return i + 1, x + step(x) * dxdt_mask
+
+    def advance_and_accumulate(i, x, mean, m2):
+        # Welford's online update of the mean and the sum of squared deviations
+        i, x = advance(i, x)
+        delta = x - mean
+        mean = mean + delta / tf.cast(i, tf.float32)
+        m2 = m2 + delta * (x - mean)
+        return i, x, mean, m2
 
+    # the trajectory is never materialized, only running moments of its tail are kept
+    _, x = tf.while_loop(lambda i, x: i < n_T - n_last_steps, advance, (0, x), parallel_iterations=1,
+                         maximum_iterations=n_T - n_last_steps)
+    _, x, mean, m2 = tf.while_loop(lambda i, x, mean, m2: i < n_last_steps, advance_and_accumulate,
+                                   (0, x, tf.zeros_like(x), tf.zeros_like(x)), parallel_iterations=1,
+                                   maximum_iterations=n_last_steps)
+    return mean, m2 / n_last_steps, x
 
-def euler_solver(x, t_mu, dT, n_T, _dXdt, n_activity_nodes=None):
+
+def heun_solver(x, mu, dT, n_T, _dXdt, n_activity_nodes=None, n_last_steps=None):
+    """Heun's ODE solver"""
+    def step(x):
+        dxdt_current = _dXdt(x, mu)
+        dxdt_next = _dXdt(x + dT * dxdt_current, mu)
+        return dT * 0.5 * (dxdt_current + dxdt_next)
+    return _integrate(x, mu, n_T, step, n_activity_nodes, n_last_steps)
+
+
+def euler_solver(x, mu, dT, n_T, _dXdt, n_activity_nodes=None, n_last_steps=None):
     """Euler's method"""
-    xs = []
-    n_x = t_mu.shape[0]
-    n_activity_nodes = n_x if n_activity_nodes is None else n_activity_nodes
-    dxdt_mask = tf.pad(tf.ones((n_activity_nodes, 1)), [[0, n_x - n_activity_nodes], [0, 0]])
-    for _ in range(n_T):
-        dxdt_current = _dXdt(x, t_mu)
-        x = x + dT * dxdt_current * dxdt_mask
-        xs.append(x)
-    xs = tf.stack(xs, axis=0)
-    return xs
+    def step(x):
+        dxdt_current = _dXdt(x, mu)
+        return dT * dxdt_current
+    return _integrate(x, mu, n_T, step, n_activity_nodes, n_last_steps)
 
 
-def midpoint_solver(x, t_mu, dT, n_T, _dXdt, n_activity_nodes=None):
+def midpoint_solver(x, mu, dT, n_T, _dXdt, n_activity_nodes=None, n_last_steps=None):
     """Midpoint method"""
-    xs = []
-    n_x = t_mu.shape[0]
-    n_activity_nodes = n_x if n_activity_nodes is None else n_activity_nodes
-    dxdt_mask = tf.pad(tf.ones((n_activity_nodes, 1)), [[0, n_x - n_activity_nodes], [0, 0]])
-    for _ in range(n_T):
-        dxdt_current = _dXdt(x, t_mu)
-        dxdt_midpoint = _dXdt(x + 0.5 * dT * dxdt_current, t_mu)
-        x = x + dT * dxdt_midpoint * dxdt_mask
-        xs.append(x)
-    xs = tf.stack(xs, axis=0)
-    return xs
+    def step(x):
+        dxdt_current = _dXdt(x, mu)
+        dxdt_midpoint = _dXdt(x + 0.5 * dT * dxdt_current, mu)
+        return dT * dxdt_midpoint
+    return _integrate(x, mu, n_T, step, n_activity_nodes, n_last_steps)
 
 
-def rk4_solver(x, t_mu, dT, n_T, _dXdt, n_activity_nodes=None):
+def rk4_solver(x, mu, dT, n_T, _dXdt, n_activity_nodes=None, n_last_steps=None):
     """Runge-Kutta method"""
-    xs = []
-    n_x = t_mu.shape[0]
-    n_activity_nodes = n_x if n_activity_nodes is None else n_activity_nodes
-    dxdt_mask = tf.pad(tf.ones((n_activity_nodes, 1)), [[0, n_x - n_activity_nodes], [0, 0]])
-    for _ in range(n_T):
-        k1 = _dXdt(x, t_mu)
-        k2 = _dXdt(x + 0.5*dT*k1, t_mu)
-        k3 = _dXdt(x + 0.5*dT*k2, t_mu)
-        k4 = _dXdt(x + dT*k3, t_mu)
-        x = x + dT * (1/6*k1+1/3*k2+1/3*k3+1/6*k4) * dxdt_mask
-        xs.append(x)
-    xs = tf.stack(xs, axis=0)
-    return xs
+    def step(x):
+        k1 = _dXdt(x, mu)
+        k2 = _dXdt(x + 0.5*dT*k1, mu)
+        k3 = _dXdt(x + 0.5*dT*k2, mu)
+        k4 = _dXdt(x + dT*k3, mu)
+        return dT * (1/6*k1+1/3*k2+1/3*k3+1/6*k4)
+    return _integrate(x, mu, n_T, step, n_activity_nodes, n_last_steps)
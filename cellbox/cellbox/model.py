@@ -44,20 +44,15 @@ class PertBio:
 
     def get_ops(self):
         """get operators for tensorflow"""
-        if self.args.weight_loss == 'expr':
-            self.train_loss, self.train_mse_loss = loss(self.train_y, self.train_yhat, self.params['W'],
-                                                        self.l1_lambda, self.l2_lambda, weight=self.train_y, alpha = 0.5)
-            self.monitor_loss, self.monitor_mse_loss = loss(self.monitor_y, self.monitor_yhat, self.params['W'],
-                                                            self.l1_lambda, self.l2_lambda, weight=self.monitor_y, alpha = 0.5)
-            self.eval_loss, self.eval_mse_loss = loss(self.eval_y, self.eval_yhat, self.params['W'],
-                                                      self.l1_lambda, self.l2_lambda, weight=self.eval_y, alpha = 0.5)
-        elif self.args.weight_loss == 'None':
-            self.train_loss, self.train_mse_loss = loss(self.train_y, self.train_yhat, self.params['W'],
-                                                        self.l1_lambda, self.l2_lambda, alpha = 0.5)
-            self.monitor_loss, self.monitor_mse_loss = loss(self.monitor_y, self.monitor_yhat, self.params['W'],
-                                                            self.l1_lambda, self.l2_lambda, alpha = 0.5)
-            self.eval_loss, self.eval_mse_loss = loss(self.eval_y, self.eval_yhat, self.params['W'],
-                                                      self.l1_lambda, self.l2_lambda, alpha = 0.5)
+        weighted = self.args.weight_loss == 'expr'
+        self.train_loss, self.train_mse_loss = loss(self.train_y, self.train_yhat, self.params['W'],
+                                                    self.l1_lambda, self.l2_lambda,
+                                                    weight=self.train_y if weighted else 1., alpha=0.5)
+        # the penalty on W is left out of monitor/eval, so early stopping tracks the unpenalized validation MSE
+        self.monitor_loss, self.monitor_mse_loss = loss(self.monitor_y, self.monitor_yhat, self.params['W'],
+                                                        weight=self.monitor_y if weighted else 1., include_reg=False)
+        self.eval_loss, self.eval_mse_loss = loss(self.eval_y, self.eval_yhat, self.params['W'],
+                                                  weight=self.eval_y if weighted else 1., include_reg=False)
         self.op_optimize = optimize(self.train_loss, self.lr)
 
     def get_variables(self):
@@ -85,19 +80,30 @@ class CellBox(PertBio):
         self.params = {}
         self.get_variables()
         if self.args.pert_form == 'by u':
-            y0 = tf.constant(np.zeros((self.n_x, 1)), name="x_init", dtype=tf.float32)
+            y0 = tf.constant(np.zeros((1, self.n_x)), name="x_init", dtype=tf.float32)
             self.train_y0 = y0
             self.monitor_y0 = y0
             self.eval_y0 = y0
             self.gradient_zero_from = None
         elif self.args.pert_form == 'fix x':  # fix level of node x (here y) by input perturbation u (here x)
-            self.train_y0 = tf.transpose(self.train_x)
-            self.monitor_y0 = tf.transpose(self.monitor_x)
-            self.eval_y0 = tf.transpose(self.eval_x)
+            self.train_y0 = self.train_x
+            self.monitor_y0 = self.monitor_x
+            self.eval_y0 = self.eval_x
             self.gradient_zero_from = self.args.n_activity_nodes
         self.envelope_fn = cellbox.kernel.get_envelope(self.args)
-        self.ode_solver = cellbox.kernel.get_ode_solver(self.args)
-        self._dxdt = cellbox.kernel.get_dxdt(self.args, self.params)
+        # the solver and dx/dt are traced once with a fixed signature; dT, n_T and ode_last_steps are bound as
+        # Python constants so that they are baked into the solver loop
+        state_spec = tf.TensorSpec([None, self.n_x], tf.float32)
+        self._dxdt = tf.function(cellbox.kernel.get_dxdt(self.args, self.params),
+                                 input_signature=[state_spec, state_spec])
+        ode_solver = cellbox.kernel.get_ode_solver(self.args)
+        dT, n_T, n_last_steps = float(self.args.dT), int(self.args.n_T), int(self.args.ode_last_steps)
+        # the masked W, the softplus rates and the dense mu are loop invariants, computed once per session run
+        self.ode_solver = tf.function(
+            lambda y0, mu: ode_solver(y0, mu, dT, n_T, self._dxdt, self.gradient_zero_from, n_last_steps),
+            input_signature=[state_spec, state_spec])
+        # train/monitor/eval batches come from separate iterators that are pulled by separate session runs, so
+        # they are not concatenated into one solve; instead all three share a single traced solver
         self.convergence_metric_train, self.train_yhat = self.forward(self.train_y0, self.train_x)
         self.convergence_metric_monitor, self.monitor_yhat = self.forward(self.monitor_y0, self.monitor_x)
         self.convergence_metric_eval, self.eval_yhat = self.forward(self.eval_y0, self.eval_x)
@@ -105,19 +111,15 @@ class CellBox(PertBio):
         return self
 
     def forward(self, y0, mu):
+        # states and perturbations are kept as [batch_size, n_x] throughout the ODE simulation
         if isinstance(mu, tf.SparseTensor):
-            mu_t = tf.sparse.to_dense(tf.sparse.transpose(mu))
-        else:
-            mu_t = tf.transpose(mu)
-        ys = self.ode_solver(y0, mu_t, self.args.dT, self.args.n_T, self._dxdt, self.gradient_zero_from)
-        # [n_T, n_x, batch_size]
-        ys = ys[-self.args.ode_last_steps:]
-        # [n_iter_tail, n_x, batch_size]
-        mean, sd = tf.nn.moments(ys, axes=0)
-        yhat = tf.transpose(ys[-1])
-        dxdt = self._dxdt(ys[-1], mu_t)
-        # [n_x, batch_size] for last ODE step
-        convergence_metric = tf.concat([mean, sd, dxdt], axis=0)
+            mu = tf.sparse.to_dense(mu)
+        # only the ODE solve is compiled by XLA
+        with tf.xla.experimental.jit_scope():
+            mean, sd, yhat = self.ode_solver(y0, mu)
+        # [batch_size, n_x] over the last ode_last_steps steps / for last ODE step
+        dxdt = self._dxdt(yhat, mu)
+        convergence_metric = tf.concat([mean, sd, dxdt], axis=1)
         return convergence_metric, yhat
 
     def get_variables(self):
@@ -127,29 +129,31 @@ class CellBox(PertBio):
         Mutates:
             self.params(dict):{
                 W (tf.Variable): interaction matrix with constraints enforced, , shape: [n_x, n_x]
-                alpha (tf.Variable): alpha, shape: [n_x, 1]
-                eps (tf.Variable): eps, shape: [n_x, 1]
+                alpha (tf.Tensor): softplus(alpha), shape: [n_x, 1]
+                eps (tf.Tensor): softplus(eps), shape: [n_x, 1]
+                psi (tf.Tensor): softplus(psi), shape: [n_x, 1], only for envelope 2
             }
         """
         n_x, n_protein_nodes, n_activity_nodes = self.n_x, self.args.n_protein_nodes, self.args.n_activity_nodes
+        """
+           Enforce constraints  (i: recipient)
+           no self regulation wii=0
+           ingoing wij for drug nodes (88th to 99th) = 0 [n_activity_nodes 87: ]
+                            w [87:99,_] = 0
+           outgoing wij for phenotypic nodes (83th to 87th) [n_protein_nodes 82 : n_activity_nodes 87]
+                            w [_, 82:87] = 0
+           ingoing wij for phenotypic nodes from drug ndoes (direct) [n_protein_nodes 82 : n_activity_nodes 87]
+                            w [82:87, 87:99] = 0
+        """
+        W_mask = np.ones((n_x, n_x), dtype=np.float32)
+        np.fill_diagonal(W_mask, 0)
+        W_mask[n_activity_nodes:, :] = 0
+        W_mask[:, n_protein_nodes:n_activity_nodes] = 0
+        W_mask[n_protein_nodes:n_activity_nodes, n_activity_nodes:] = 0
+        self._W_mask = tf.constant(W_mask, name="W_mask")
         with tf_v1.variable_scope("initialization", reuse=True):
-            """
-               Enforce constraints  (i: recipient)
-               no self regulation wii=0
-               ingoing wij for drug nodes (88th to 99th) = 0 [n_activity_nodes 87: ]
-                                w [87:99,_] = 0
-               outgoing wij for phenotypic nodes (83th to 87th) [n_protein_nodes 82 : n_activity_nodes 87]
-                                w [_, 82:87] = 0
-               ingoing wij for phenotypic nodes from drug ndoes (direct) [n_protein_nodes 82 : n_activity_nodes 87]
-                                w [82:87, 87:99] = 0
-            """
-            W = tf.Variable(np.random.normal(0.01, size=(n_x, n_x)), name="W", dtype=tf.float32)
-            W_mask = (1.0 - np.diag(np.ones([n_x])))
-            W_mask[n_activity_nodes:, :] = np.zeros([n_x - n_activity_nodes, n_x])
-            W_mask[:, n_protein_nodes:n_activity_nodes] = np.zeros([n_x, n_activity_nodes - n_protein_nodes])
-            W_mask[n_protein_nodes:n_activity_nodes, n_activity_nodes:] = np.zeros([n_activity_nodes - n_protein_nodes,
-                                                                                    n_x - n_activity_nodes])
-            self.params['W'] = W_mask * W
+            W = tf.Variable(np.random.normal(0, 0.01, size=(n_x, n_x)), name="W", dtype=tf.float32)
+            self.params['W'] = self._W_mask * W
 
             eps = tf.Variable(np.ones((n_x, 1)), name="eps", dtype=tf.float32)
             alpha = tf.Variable(np.ones((n_x, 1)), name="alpha", dtype=tf.float32)
@@ -166,12 +170,12 @@ class LinReg(PertBio):
     def get_variables(self):
         with tf_v1.variable_scope("initialization", reuse=True):
             self.params.update({
-                'W': tf.Variable(np.random.normal(0.01, size=(self.n_x, self.n_x)), name="W", dtype=tf.float32),
-                'b': tf.Variable(np.random.normal(0.01, size=(self.n_x, 1)), name="b", dtype=tf.float32)
+                'W': tf.Variable(np.random.normal(0, 0.01, size=(self.n_x, self.n_x)), name="W", dtype=tf.float32),
+                'b': tf.Variable(np.random.normal(0, 0.01, size=self.n_x), name="b", dtype=tf.float32)
             })
 
     def forward(self, x, mu):
-        xhat = tf.matmul(mu, self.params['W']) + tf.reshape(self.params['b'], [1, -1])
+        xhat = tf.matmul(mu, self.params['W']) + self.params['b']
         return xhat
 
 
@@ -180,25 +184,25 @@ class NN(LinReg):
     def get_variables(self):
         with tf_v1.variable_scope("initialization", reuse=True):
             self.params.update({
-                'W_h': tf.Variable(np.random.normal(0.01, size=(self.n_x, self.args.n_hidden)), name="Wh",
+                'W_h': tf.Variable(np.random.normal(0, 0.01, size=(self.n_x, self.args.n_hidden)), name="Wh",
                                    dtype=tf.float32),
-                'b_h': tf.Variable(np.random.normal(0.01, size=(self.args.n_hidden, 1)), name="bh", dtype=tf.float32),
-                'W': tf.Variable(np.random.normal(0.01, size=(self.args.n_hidden, self.n_x)), name="Wo",
+                'b_h': tf.Variable(np.random.normal(0, 0.01, size=self.args.n_hidden), name="bh", dtype=tf.float32),
+                'W': tf.Variable(np.random.normal(0, 0.01, size=(self.args.n_hidden, self.n_x)), name="Wo",
                                  dtype=tf.float32),
-                'b': tf.Variable(np.random.normal(0.01, size=(self.n_x, 1)), name="bo", dtype=tf.float32)
+                'b': tf.Variable(np.random.normal(0, 0.01, size=self.n_x), name="bo", dtype=tf.float32)
             })
 
     def forward(self, x, mu):
-        hidden = tf.tanh(tf.matmul(mu, self.params['W_h']) + tf.reshape(self.params['b_h'], [1, -1]))
-        xhat = tf.matmul(hidden, self.params['W']) + tf.reshape(self.params['b'], [1, -1])
+        with tf.xla.experimental.jit_scope():
+            hidden = tf.tanh(tf.nn.bias_add(tf.matmul(mu, self.params['W_h']), self.params['b_h']))
+            xhat = tf.nn.bias_add(tf.matmul(hidden, self.params['W']), self.params['b'])
         return xhat
 
 
 def get_idx_pair(mu):
     """get perturbation position"""
-    idx = np.where(mu != 0)[0]
-    idx = [idx[0], idx[-1]]
-    return idx
+    idx = np.flatnonzero(mu)
+    return [idx[0], idx[-1]]
 
 
 class CoExp(PertBio):
@@ -211,27 +215,41 @@ class CoExp(PertBio):
         # self.mu_full = tf.constant(self.args.dataset['pert_full'], dtype=tf.float32)
         # self.idx_full = tf.map_fn(fn=self.get_idx_pair, elems=self.mu_full, dtype=tf.int32)
         self.mu_full = self.args.dataset['pert_full'].values
-        self.pos_full = [get_idx_pair(mu) for mu in self.mu_full]
+        # first and last perturbed node of every condition, [n_conditions, 2]
+        nz = self.mu_full != 0
+        assert nz.any(axis=1).all(), "every condition needs at least one perturbed node"
+        first = nz.argmax(axis=1)
+        last = nz.shape[1] - 1 - nz[:, ::-1].argmax(axis=1)
+        self.pos_full = np.stack([first, last], axis=1).astype(np.int32)
+        # only the (i, j) pairs present in the data get a model, pair_map[i, j] is the index of that model
+        pairs = np.unique(self.pos_full, axis=0)
+        pair_map = np.zeros([self.n_x, self.n_x], dtype=np.int32)
+        pair_map[pairs[:, 0], pairs[:, 1]] = np.arange(len(pairs))
+        self.n_pairs = len(pairs)
+        self.pair_map = tf.constant(pair_map)
 
     def get_variables(self):
         with tf_v1.variable_scope("initialization", reuse=True):
-            Ws = tf.Variable(np.zeros([self.args.n_x, self.args.n_x, 2, self.args.n_x]), dtype=tf.float32)
-            bs = tf.Variable(np.zeros([self.args.n_x, self.args.n_x, self.args.n_x]), dtype=tf.float32)
+            Ws = tf.Variable(np.zeros([self.n_pairs, 2, self.args.n_x]), dtype=tf.float32)
+            bs = tf.Variable(np.zeros([self.n_pairs, self.args.n_x]), dtype=tf.float32)
         self.params.update({'Ws': Ws, 'bs': bs})
 
     def _forward_unit(self, x, i, j):
         # x [2 x batch_size]
-        W = self.params['Ws'][i, j]  # [2, n_x]
-        b = self.params['bs'][i, j]  # [n_x]
+        p = self.pair_map[i, j]
+        W = self.params['Ws'][p]  # [2, n_x]
+        b = self.params['bs'][p]  # [n_x]
         xij = tf.stack([x[i], x[j]])  # [2]
         xhat = tf.matmul(tf.expand_dims(xij, 0), W) + b  # [1, n_x]
         return tf.reshape(xhat[0], [-1])  # [n_x]
 
     def _forward_1(self, x):
-        xhat_list = []
-        for pos in self.pos:
-            xhat_list.append(self._forward_unit(x, pos[0], pos[1]))
-        xhat = tf.stack(xhat_list)  # [all_model, 99]
+        # x [batch_size, n_x], evaluate all models on the whole batch at once
+        p = tf.gather_nd(self.pair_map, self.pos)  # [all_model]
+        W = tf.gather(self.params['Ws'], p)  # [all_model, 2, n_x]
+        b = tf.gather(self.params['bs'], p)  # [all_model, n_x]
+        xij = tf.gather(x, self.pos, axis=1)  # [batch_size, all_model, 2]
+        xhat = tf.einsum('bpi,pio->bpo', xij, W) + b  # [batch_size, all_model, n_x]
         return xhat
 
     def _forward_2(self, i, x):
@@ -242,8 +260,8 @@ class CoExp(PertBio):
     def forward(self, x_gold, training, pos=None, idx=None):
         # calculate xhats from all possible models
         if training:
-            self.pos = pos
-            xhats = tf.map_fn(fn=self._forward_1, elems=x_gold)
+            self.pos = tf.constant(pos, dtype=tf.int32)
+            xhats = self._forward_1(x_gold)
             xhats_avg = tf.reduce_mean(xhats, axis=1)
             return xhats_avg
         self.pos = tf.constant(self.pos_full)
@@ -273,8 +291,8 @@ class CoExpNonlinear(CoExp):
     # currently deprecated, use scikit-learn to construct co-exp models until the further updates
     def get_variables(self):
         with tf_v1.variable_scope("initialization", reuse=True):
-            Ws = tf.Variable(np.zeros([self.args.n_x, self.args.n_x, self.n_x, self.n_x]), dtype=tf.float32)
-            bs = tf.Variable(np.zeros([self.args.n_x, self.args.n_x, self.n_x, 1]), dtype=tf.float32)
+            Ws = tf.Variable(np.zeros([self.n_pairs, self.n_x, self.n_x]), dtype=tf.float32)
+            bs = tf.Variable(np.zeros([self.n_pairs, self.n_x, 1]), dtype=tf.float32)
             W = tf.Variable(np.zeros([self.n_x, 1]), dtype=tf.float32)
             b = tf.Variable(np.zeros([self.n_x, 1]), dtype=tf.float32)
         self.params.update({'Ws': Ws, 'bs': bs, 'W': W, 'b': b})
@@ -283,8 +301,9 @@ class CoExpNonlinear(CoExp):
     # # during training, use mu_full, while during testing use mu
     # idx = tf.map_fn(fn=get_idx_pair, elems=mu, dtype=tf.int32)
     # # mask the models for prediction
-    # Ws = tf.gather_nd(self.params['Ws'], idx)  # batch_size x [Params,]
-    # bs = tf.gather_nd(self.params['bs'], idx)
+    # p = tf.gather_nd(self.pair_map, idx)
+    # Ws = tf.gather(self.params['Ws'], p)  # batch_size x [Params,]
+    # bs = tf.gather(self.params['bs'], p)
     # hidden = tf.tensordot(Ws, tf.transpose(x_gold), axes=1) + bs  # batch_size x [Params,] x batch_size
     # hidden_transposed = tf.transpose(hidden, perm=[0, 2, 1])
     # hidden_masked = tf.gather_nd(hidden_transposed, tf.compat.v2.where(tf.eye(tf.shape(mu)[0])))
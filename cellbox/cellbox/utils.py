@@ -9,7 +9,25 @@ import tensorflow as tf
 import json
 import tensorflow._api.v2.compat.v1 as tf_v1
 
-def loss(x_gold, x_hat, W, l1=0, l2=0, weight=1., alpha = 0.5):
+def mse_loss(x_gold, x_hat, weight=1.):
+    """evaluate the (weighted) mean squared error between the original and the predicted data"""
+    if isinstance(x_gold, tf.SparseTensor):
+        x_gold = tf.sparse.to_dense(x_gold)
+
+    with tf_v1.variable_scope("loss", reuse=True):
+        loss_mse = tf.reduce_mean(tf.square(x_gold - x_hat) * tf.abs(weight))
+    return loss_mse
+
+
+def regularization(W, l1=0, l2=0, alpha=0.5):
+    """evaluate the elastic net penalty on W, alpha balances the l1 and l2 terms"""
+    with tf_v1.variable_scope("loss", reuse=True):
+        l1_loss = l1 * tf.reduce_sum(tf.abs(W))
+        l2_loss = l2 * tf.reduce_sum(tf.square(tf.abs(W)))
+    return 2 * alpha * l1_loss + 2 * (1 - alpha) * l2_loss
+
+
+def loss(x_gold, x_hat, W, l1=0, l2=0, weight=1., alpha = 0.5, include_reg=True):
     """evaluate loss"""
     """Parameters:
        x_gold: original data
@@ -18,17 +36,14 @@ def loss(x_gold, x_hat, W, l1=0, l2=0, weight=1., alpha = 0.5):
        l1: l1 Norm that defined by sum of abs of each elements
        l2: Euclid Norm 
        alpha: remote cofficient between l1 and l2
+       include_reg: whether to add the l1/l2 penalty on W (not needed for monitoring/evaluation losses)
     Returns:
         returns loss value.
     """
-    if isinstance(x_gold, tf.SparseTensor):
-        x_gold = tf.sparse.to_dense(x_gold)
-
-    with tf_v1.variable_scope("loss", reuse=True):
-        loss_mse = tf.reduce_mean(tf.square(x_gold - x_hat) * tf.abs(weight))
-        l1_loss = l1 * tf.reduce_sum(tf.abs(W))
-        l2_loss = l2 * tf.reduce_sum(tf.square(tf.abs(W)))
-        loss_full = loss_mse + 2 * alpha * l1_loss + 2 * (1 - alpha) * l2_loss
+    loss_mse = mse_loss(x_gold, x_hat, weight)
+    if not include_reg:
+        return loss_mse, loss_mse
+    loss_full = loss_mse + regularization(W, l1, l2, alpha)
     return loss_full, loss_mse
 
 # We use tf.keras.optimizers.Adam instead of tf_v1.train.AdamOptimizer
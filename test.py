@@ -1,7 +1,10 @@
 import pytest
 import os
 import glob
+from argparse import Namespace
+import numpy as np
 import tensorflow as tf
+import cellbox
 
 def test_model():
     os.system('python scripts/main.py -config=configs/Example.minimal.json')
@@ -9,6 +12,86 @@ def test_model():
     assert len(files)==1
 
 
+@pytest.mark.parametrize('solver', ['euler', 'heun', 'midpoint', 'rk4'])
+@pytest.mark.parametrize('n_last_steps', [1, 3, 10, 20])
+def test_ode_solver(solver, n_last_steps):
+    """compare the looped solvers against an unrolled NumPy reference"""
+    n_x, n_activity_nodes, batch_size, n_T, dT = 5, 4, 3, 10, 0.1
+    rng = np.random.RandomState(0)
+    W = rng.normal(0, 0.5, size=(n_x, n_x)).astype(np.float32)
+    mu = rng.normal(0, 1, size=(batch_size, n_x)).astype(np.float32)
+
+    def f(x):
+        return np.tanh(x.dot(W.T) + mu) - x
+
+    increments = {
+        'euler': f,
+        'heun': lambda x: 0.5 * (f(x) + f(x + dT * f(x))),
+        'midpoint': lambda x: f(x + 0.5 * dT * f(x)),
+        'rk4': lambda x: rk4_increment(f, x, dT),
+    }
+    mask = np.concatenate([np.ones(n_activity_nodes), np.zeros(n_x - n_activity_nodes)])
+    x, xs = np.zeros((batch_size, n_x)), []
+    for _ in range(n_T):
+        x = x + dT * increments[solver](x) * mask
+        xs.append(x)
+    tail = np.stack(xs)[-n_last_steps:]
+
+    with tf.Graph().as_default():
+        ode_solver = cellbox.kernel.get_ode_solver(Namespace(ode_solver=solver))
+        outputs = ode_solver(tf.zeros((1, n_x)), tf.constant(mu), dT, n_T,
+                             lambda x, u: tf.tanh(tf.matmul(x, W, transpose_b=True) + u) - x,
+                             n_activity_nodes, n_last_steps)
+        with tf.compat.v1.Session() as sess:
+            mean, var, x_last = sess.run(outputs)
+
+    np.testing.assert_allclose(mean, tail.mean(axis=0), rtol=1e-4, atol=1e-6)
+    np.testing.assert_allclose(var, tail.var(axis=0), rtol=1e-3, atol=1e-6)
+    np.testing.assert_allclose(x_last, xs[-1], rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize('ode_degree', [1, 2])
+@pytest.mark.parametrize('envelope', [0, 1, 2])
+@pytest.mark.parametrize('ode_precision', ['float32', 'bfloat16'])
+def test_dxdt(ode_degree, envelope, ode_precision):
+    """compare dx/dt on [batch_size, n_x] states against a NumPy reference"""
+    n_x, batch_size = 5, 3
+    rng = np.random.RandomState(0)
+    W = rng.normal(0, 0.5, size=(n_x, n_x)).astype(np.float32)
+    eps, alpha, psi = rng.uniform(0.5, 1.5, size=(3, n_x, 1)).astype(np.float32)
+    x = rng.normal(0, 1, size=(batch_size, n_x)).astype(np.float32)
+    mu = rng.normal(0, 1, size=(batch_size, n_x)).astype(np.float32)
+
+    weighted_sum = x.dot(W.T) + (W.sum(axis=1) * x if ode_degree == 2 else 0)
+    expected = {
+        0: eps.T * np.tanh(weighted_sum + mu) - alpha.T * x,
+        1: eps.T * (np.tanh(weighted_sum) + mu) - alpha.T * x,
+        2: eps.T * np.tanh(weighted_sum) + psi.T * mu - alpha.T * x,
+    }[envelope]
+
+    args = Namespace(ode_degree=ode_degree, envelope=envelope, envelope_fn=tf.tanh, ode_precision=ode_precision,
+                     n_x=n_x)
+    with tf.Graph().as_default():
+        params = {'W': tf.constant(W), 'eps': tf.constant(eps), 'alpha': tf.constant(alpha), 'psi': tf.constant(psi)}
+        dxdt = cellbox.kernel.get_dxdt(args, params)(tf.constant(x), tf.constant(mu))
+        with tf.compat.v1.Session() as sess:
+            result = sess.run(dxdt)
+
+    assert result.shape == (batch_size, n_x)
+    if ode_precision == 'bfloat16':
+        np.testing.assert_allclose(result, expected, rtol=0, atol=5e-2)
+    else:
+        np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6)
+
+
+def rk4_increment(f, x, dT):
+    k1 = f(x)
+    k2 = f(x + 0.5 * dT * k1)
+    k3 = f(x + 0.5 * dT * k2)
+    k4 = f(x + dT * k3)
+    return 1 / 6 * k1 + 1 / 3 * k2 + 1 / 3 * k3 + 1 / 6 * k4
+
+
 if __name__ == '__main__':
 
-    pytest.main(args=['-sv', os.path.abspath(__file__)])
\ No newline at end of file
+    pytest.main(args=['-sv', os.path.abspath(__file__)])